@@ -8,7 +8,10 @@ import itertools
 import json
 import os
 import random
+import sys
+import threading
 import time
+import tracemalloc
 import unicodedata
 
 import http.client
@@ -83,20 +86,133 @@ class Message:
     self.timestamp = time.time()
     self.message = message
 
+class Section:
+  """Accumulates wall time spent inside a tagged section of code, per
+  (section, team).  Time spent suspended in an await inside the block
+  is included."""
+
+  TIMES = collections.Counter()
+  CALLS = collections.Counter()
+
+  def __init__(self, name, team):
+    self.key = (name, str(team))
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+
+  def __exit__(self, *args):
+    self.TIMES[self.key] += time.perf_counter() - self.start
+    self.CALLS[self.key] += 1
+
+
+class Sampler:
+  """Periodically samples the stack of one thread (normally the one
+  running the event loop) from a background thread."""
+
+  def __init__(self, interval=0.005):
+    self.interval = interval
+    self.ident = threading.get_ident()
+    self.self_counts = collections.Counter()
+    self.total_counts = collections.Counter()
+    self.samples = 0
+    self.stop_event = threading.Event()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.stop_event.set()
+    self.thread.join()
+
+  def run(self):
+    while not self.stop_event.wait(self.interval):
+      frame = sys._current_frames().get(self.ident)
+      if frame is None: continue
+      self.samples += 1
+      seen = set()
+      leaf = True
+      while frame:
+        code = frame.f_code
+        key = f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+        if leaf:
+          self.self_counts[key] += 1
+          leaf = False
+        if key not in seen:
+          self.total_counts[key] += 1
+          seen.add(key)
+        frame = frame.f_back
+
+  def hot_spots(self, count=30):
+    n = max(self.samples, 1)
+    def top(counter):
+      return [{"function": k, "samples": v, "fraction": round(v / n, 4)}
+              for k, v in counter.most_common(count)]
+    return {"samples": self.samples,
+            "self": top(self.self_counts),
+            "total": top(self.total_counts)}
+
+
+class TrafficRecorder:
+  """Appends every inbound game event to a JSON-lines log, so that a
+  session can be fed back through GameState later by replay_hat.py.
+  Events are buffered in memory; flush() (called from the purger) does
+  the disk I/O on a worker thread, off the event loop."""
+
+  def __init__(self, fn, seed, min_players):
+    self.f = open(fn, "w")
+    header = {"method": "header", "seed": seed, "min_players": min_players}
+    self.f.write(json.dumps(header) + "\n")
+    self.f.flush()
+    self.pending = []
+
+  def record(self, method, team, session=None, wid=None, **kwargs):
+    d = {"time": GameState.now(),
+         "method": method,
+         "team": str(team),
+         "size": team.size,
+         "session": session,
+         "wid": wid}
+    d.update(kwargs)
+    self.pending.append(json.dumps(d) + "\n")
+
+  async def flush(self):
+    if not self.pending: return
+    lines, self.pending = self.pending, []
+    await asyncio.get_event_loop().run_in_executor(None, self.write, lines)
+
+  def write(self, lines):
+    self.f.writelines(lines)
+    self.f.flush()
+
+
 class GameState:
   BY_TEAM = {}
 
+  # team name: summary dict, replaced wholesale by publish() so readers
+  # never need the team's condition.
+  SNAPSHOTS = {}
+
+  # Replaced by replay_hat.py to run games under a virtual clock.
+  now = staticmethod(time.time)
+  sleep = staticmethod(asyncio.sleep)
+
+  recorder = None
+
   @classmethod
   async def purger(cls):
     while True:
       for t in cls.BY_TEAM.values():
-        await t.purge(time.time())
-      await asyncio.sleep(2.0)
+        await t.purge(cls.now())
+      if cls.recorder:
+        await cls.recorder.flush()
+      await cls.sleep(2.0)
 
   @classmethod
-  def set_globals(cls, options, venn_sets):
+  def set_globals(cls, options, venn_sets, seed):
     cls.options = options
     cls.venn_sets = venn_sets
+    cls.seed = seed
 
   @classmethod
   def get_for_team(cls, team):
@@ -110,17 +226,43 @@ class GameState:
     self.wid_sessions = {}
     self.running = False
     self.cond = asyncio.Condition()
+    self.phase = "waiting"
+    # Each team gets its own generator, so that what a team draws
+    # doesn't depend on how its game interleaves with everyone else's.
+    if self.seed is None:
+      self.random = random.Random()
+    else:
+      self.random = random.Random(f"{self.seed}:{team}")
+    self.current_vs = None
+    self.progress_time = self.now()
 
     self.current_word = None
+    self.placement = {}
     self.solved = set()
     self.venn_centers = set()
     self.widq = collections.deque()
     self.wids = {}
 
     self.min_size = scrum.default_min_players(self.options, team.size)
+    self.publish()
+
+  def publish(self, progress=False):
+    if progress:
+      self.progress_time = self.now()
+    self.SNAPSHOTS[str(self.team)] = {
+      "phase": self.phase,
+      "venn_set": (self.venn_sets.index(self.current_vs) + 1
+                   if self.current_vs else None),
+      # sessions is never pruned, so count the sessions that still
+      # have a live wid.
+      "players": len(set(self.wid_sessions[w] for w in self.wids
+                         if w in self.wid_sessions)),
+      "since": self.progress_time}
 
   async def on_wait(self, session, wid):
-    now = time.time()
+    if self.recorder:
+      self.recorder.record("on_wait", self.team, session, wid)
+    now = self.now()
     wid = f"w{wid}"
     self.widq.append((wid, now))
 
@@ -134,23 +276,31 @@ class GameState:
       await self.purge(now)
 
     self.wid_sessions[wid] = session
+    if count == 1:
+      self.publish()
 
     async with self.cond:
       if session not in self.sessions:
         self.sessions[session] = None
         self.cond.notify_all()
 
+  async def send_messages(self, msgs, **kwargs):
+    with Section("send_messages", self.team):
+      await self.team.send_messages(msgs, **kwargs)
+
   async def purge(self, now):
     expire = now - HatVennDorApp.WAIT_TIMEOUT * 2
     notify = False
-    while self.widq and self.widq[0][1] < expire:
-      x = self.widq.popleft()
-      if self.wids[x[0]] > 1:
-        self.wids[x[0]] -= 1
-      else:
-        del self.wids[x[0]]
-        notify = True
+    with Section("purge", self.team):
+      while self.widq and self.widq[0][1] < expire:
+        x = self.widq.popleft()
+        if self.wids[x[0]] > 1:
+          self.wids[x[0]] -= 1
+        else:
+          del self.wids[x[0]]
+          notify = True
     if notify:
+      self.publish()
       async with self.cond:
         self.cond.notify_all()
 
@@ -162,7 +312,7 @@ class GameState:
         f"You need {self.min_size} people to enter the hat shop.<br>"
         f"{count} {'is' if count == 1 else 'are'} currently waiting.")
       msg = {"method": "show_message", "text": text}
-      await self.team.send_messages([msg], sticky=1)
+      await self.send_messages([msg], sticky=1)
       async with self.cond:
         await self.cond.wait()
 
@@ -171,18 +321,20 @@ class GameState:
 
       # clue phase
       self.phase = "clue"
+      self.publish(progress=True)
       for w in vs.clue_order:
         self.current_word = w
         d = {"method": "show_clue", "clue": w.clue}
-        await self.team.send_messages([d], sticky=1)
+        await self.send_messages([d], sticky=1)
 
         async with self.cond:
           while w not in self.solved:
             await self.cond.wait()
+        self.publish(progress=True)
 
         d = {"method": "show_answer", "answer": w.answer}
-        await self.team.send_messages([d], sticky=1)
-        await asyncio.sleep(1.5)
+        await self.send_messages([d], sticky=1)
+        await self.sleep(1.5)
 
       # divide chunks into min_size sets
       chunk_sets = [[] for i in range(self.min_size)]
@@ -190,7 +342,7 @@ class GameState:
         chunk_sets[i % len(chunk_sets)].append(ch)
 
       x = [tuple(cs) for cs in chunk_sets]
-      random.shuffle(x)
+      self.random.shuffle(x)
       chunk_set_counts = {0: x}
       chunk_set_uses = {}
 
@@ -207,38 +359,41 @@ class GameState:
       self.placement = {}   # wid: {chunk: location}
 
       # venn phase
+      self.phase = "venn"
+      self.publish(progress=True)
       self.targets = [[] for i in range(6)]
       self.success = False
 
       while not self.success:
-        to_delete = set()
-        for wid in self.assignment:
-          if wid not in self.wids:
-            to_delete.add(wid)
-        if to_delete:
-          for wid in to_delete:
-            self.placement.pop(wid)
-            chunk_set = self.assignment.pop(wid)
-            c = chunk_set_uses[chunk_set]
-            chunk_set_counts[c].remove(chunk_set)
-            chunk_set_counts[c-1].append(chunk_set)
-            chunk_set_uses[chunk_set] = c-1
-
-          # Remove any chunks a purged wid had in the targets.
-          for i in range(len(self.targets)):
-            self.targets[i] = [x for x in self.targets[i] if x[1] not in to_delete]
-
-        for wid in self.wids:
-          if wid not in self.assignment:
-            chunk_set = get_chunk_set()
-            self.assignment[wid] = chunk_set
-            self.placement[wid] = dict((k, None) for k in chunk_set)
-
-        d = {"method": "venn_state",
-             "chunks": self.assignment,
-             "targets": self.targets,
-             "words": [i[0] for i in vs.clue_order]}
-        await self.team.send_messages([d], sticky=1)
+        with Section("venn_loop", self.team):
+          # A list in assignment order, not a set: set order for strings
+          # varies between processes, and it decides which chunk set the
+          # next new wid is given.
+          to_delete = [wid for wid in self.assignment if wid not in self.wids]
+          if to_delete:
+            for wid in to_delete:
+              self.placement.pop(wid)
+              chunk_set = self.assignment.pop(wid)
+              c = chunk_set_uses[chunk_set]
+              chunk_set_counts[c].remove(chunk_set)
+              chunk_set_counts[c-1].append(chunk_set)
+              chunk_set_uses[chunk_set] = c-1
+
+            # Remove any chunks a purged wid had in the targets.
+            for i in range(len(self.targets)):
+              self.targets[i] = [x for x in self.targets[i] if x[1] not in to_delete]
+
+          for wid in self.wids:
+            if wid not in self.assignment:
+              chunk_set = get_chunk_set()
+              self.assignment[wid] = chunk_set
+              self.placement[wid] = dict((k, None) for k in chunk_set)
+
+          d = {"method": "venn_state",
+               "chunks": self.assignment,
+               "targets": self.targets,
+               "words": [i[0] for i in vs.clue_order]}
+        await self.send_messages([d], sticky=1)
 
         async with self.cond:
           await self.cond.wait()
@@ -249,9 +404,10 @@ class GameState:
 
       # prompt for the center entry
       self.phase = "final"
+      self.publish(progress=True)
       d = {"method": "venn_complete",
            "targets": target_words}
-      await self.team.send_messages([d], sticky=1)
+      await self.send_messages([d], sticky=1)
 
       async with self.cond:
         while vs.finalanswer not in self.venn_centers:
@@ -261,19 +417,25 @@ class GameState:
       d = {"method": "center_complete",
            "targets": target_words,
            "answer": vs.finalanswer}
-      await self.team.send_messages([d], sticky=1)
-      await asyncio.sleep(3.0)
+      await self.send_messages([d], sticky=1)
+      await self.sleep(3.0)
 
+    self.phase = "done"
+    self.publish(progress=True)
     text = f'<img src="{self.options.assets["endcard.png"]}">'
     msg = {"method": "show_message", "text": text}
-    await self.team.send_messages([msg], sticky=1)
+    await self.send_messages([msg], sticky=1)
 
 
   async def send_chat(self, text):
+    if self.recorder:
+      self.recorder.record("send_chat", self.team, text=text)
     d = {"method": "add_chat", "text": text}
-    await self.team.send_messages([d])
+    await self.send_messages([d])
 
   async def try_answer(self, answer):
+    if self.recorder:
+      self.recorder.record("try_answer", self.team, answer=answer)
     async with self.cond:
       if self.phase == "clue":
         if (self.current_word not in self.solved and
@@ -287,7 +449,10 @@ class GameState:
           self.cond.notify_all()
 
   async def set_name(self, session, name):
+    if self.recorder:
+      self.recorder.record("set_name", self.team, session, name=name)
     self.sessions[session] = name
+    self.publish()
 
     players = []
     for n in self.sessions.values():
@@ -300,9 +465,12 @@ class GameState:
     players = ", ".join(p[1] for p in players)
     players = html.escape(players)
 
-    await self.team.send_messages([{"method": "players", "players": players}])
+    await self.send_messages([{"method": "players", "players": players}])
 
   async def place_chunk(self, session, wid, chunk, target):
+    if self.recorder:
+      self.recorder.record("place_chunk", self.team, session, wid,
+                           chunk=chunk, target=target)
     if self.wid_sessions.get(wid) != session:
       print(f"bad wid {wid} for session")
       return
@@ -327,16 +495,18 @@ class GameState:
       self.cond.notify_all()
 
   def check_targets(self):
-    current = []
-    for t in self.targets:
-      a = "".join(c[0] for i, c in enumerate(t) if i == 0 or c[0] != t[i-1][0])
-      if not a: return
-      current.append(a)
-    current = ",".join(current)
+    with Section("check_targets", self.team):
+      current = []
+      for t in self.targets:
+        a = "".join(c[0] for i, c in enumerate(t)
+                    if i == 0 or c[0] != t[i-1][0])
+        if not a: return
+        current.append(a)
+      current = ",".join(current)
 
-    print(f"current set: {current}")
-    if current in self.current_vs.permutations:
-      self.success = True
+      print(f"current set: {current}")
+      if current in self.current_vs.permutations:
+        self.success = True
 
 
 class HatVennDorApp(scrum.ScrumApp):
@@ -420,6 +590,84 @@ class NameHandler(tornado.web.RequestHandler):
     self.set_status(http.client.NO_CONTENT.value)
 
 
+class OpsHandler(tornado.web.RequestHandler):
+  CACHE_TTL = 2.0
+
+  cached = None
+  cached_time = 0
+
+  def get(self):
+    options = GameState.options
+    if self.get_argument("key", None) != options.ops_key:
+      raise tornado.web.HTTPError(http.client.FORBIDDEN.value)
+
+    now = GameState.now()
+    cls = self.__class__
+    if cls.cached is None or now - cls.cached_time > self.CACHE_TTL:
+      teams = {}
+      for team, snap in list(GameState.SNAPSHOTS.items()):
+        snap = dict(snap)
+        # Only a game in progress can be stuck.
+        if snap["phase"] in ("waiting", "done"):
+          snap["stuck"] = None
+        else:
+          snap["stuck"] = round(now - snap["since"], 1)
+        teams[team] = snap
+      cls.cached = json.dumps({"time": now, "teams": teams})
+      cls.cached_time = now
+
+    self.set_header("Content-Type", "application/json")
+    self.write(cls.cached)
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+  MAX_SECONDS = 60
+
+  running = False
+
+  async def get(self, seconds):
+    cls = self.__class__
+    if cls.running:
+      raise tornado.web.HTTPError(http.client.CONFLICT.value)
+    seconds = min(int(seconds, 10), self.MAX_SECONDS)
+
+    cls.running = True
+    start_sections = collections.Counter(Section.TIMES)
+    start_calls = collections.Counter(Section.CALLS)
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+      tracemalloc.start()
+    sampler = Sampler()
+    sampler.start()
+    try:
+      await asyncio.sleep(seconds)
+      snapshot = tracemalloc.take_snapshot()
+    finally:
+      sampler.stop()
+      if started_tracing:
+        tracemalloc.stop()
+      cls.running = False
+
+    snapshot = snapshot.filter_traces(
+      (tracemalloc.Filter(False, tracemalloc.__file__),))
+    memory = [{"where": str(stat.traceback),
+               "size": stat.size,
+               "count": stat.count}
+              for stat in snapshot.statistics("lineno")[:30]]
+
+    sections = Section.TIMES - start_sections
+    calls = Section.CALLS - start_calls
+    sections = [{"section": name, "team": team,
+                 "seconds": round(t, 6), "calls": calls[(name, team)]}
+                for (name, team), t in sections.most_common()]
+
+    self.set_header("Content-Type", "application/json")
+    self.write(json.dumps({"seconds": seconds,
+                           "cpu": sampler.hot_spots(),
+                           "memory": memory,
+                           "sections": sections}))
+
+
 class DebugHandler(tornado.web.RequestHandler):
   def get(self, fn):
     if fn.endswith(".css"):
@@ -431,6 +679,13 @@ class DebugHandler(tornado.web.RequestHandler):
 
 
 def make_app(options):
+  # A recorded game can only be replayed if its randomness can be too.
+  seed = options.seed
+  if seed is None and options.record_file:
+    seed = random.randrange(2**32)
+  if seed is not None:
+    random.seed(seed)
+
   venn_sets = (
     VennSet("WOOD", 1, """
     M  PL-AS-TIC	The "Great Pacific Garbage Patch" is mostly composed of micro-particles of this.
@@ -487,7 +742,10 @@ def make_app(options):
     """),
   )
 
-  GameState.set_globals(options, venn_sets)
+  GameState.set_globals(options, venn_sets, seed)
+  if options.record_file:
+    GameState.recorder = TrafficRecorder(options.record_file, seed,
+                                         options.min_players)
 
   loop = asyncio.get_event_loop()
   loop.create_task(GameState.purger())
@@ -498,8 +756,11 @@ def make_app(options):
     (r"/hatname", NameHandler),
     (r"/hatplace/([A-Z]+)/(w\d+)/(bank|\d+)", PlaceHandler),
   ]
+  if options.ops_key:
+    handlers.append((r"/hatops", OpsHandler))
   if options.debug:
     handlers.append((r"/hatdebug/(\S+)", DebugHandler))
+    handlers.append((r"/hatprofile/(\d+)", ProfileHandler))
   return handlers
 
 
@@ -520,6 +781,13 @@ def main():
                       help="Port to use for requests to main server.")
   parser.add_argument("--min_players", type=int, default=None,
                       help="Number of players needed to start game.")
+  parser.add_argument("--record_file", default=None,
+                      help="Write all inbound game events to this file.")
+  parser.add_argument("--seed", type=int, default=None,
+                      help="Seed for random (chosen automatically when "
+                      "recording).")
+  parser.add_argument("--ops_key", default=None,
+                      help="Enable /hatops, requiring ?key= to match this.")
 
   options = parser.parse_args()
 
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+# Replays a log written by hat_venn_dor.py --record_file through
+# GameState, as fast as possible, under a virtual clock.  The log
+# starts with the seed and --min_players the recording server used, so
+# the replay deals out the same chunks and is deterministic; the
+# timings it reports can be compared across versions of the server.
+
+import argparse
+import asyncio
+import collections
+import heapq
+import itertools
+import json
+import time
+
+import hat_venn_dor
+from hat_venn_dor import GameState
+
+
+class VirtualClock:
+  def __init__(self, start, on_wake=None):
+    self.current = start
+    self.sleepers = []   # heap of (deadline, seq, future)
+    self.seq = itertools.count()
+    self.on_wake = on_wake   # called with the time after each wakeup
+
+  def now(self):
+    return self.current
+
+  async def sleep(self, delay):
+    fut = asyncio.get_event_loop().create_future()
+    heapq.heappush(self.sleepers, (self.current + delay, next(self.seq), fut))
+    await fut
+
+  async def advance_to(self, t):
+    # Wake everyone whose deadline has passed, in deadline order,
+    # letting each run before moving time forward again.
+    while self.sleepers and self.sleepers[0][0] <= t:
+      deadline, _, fut = heapq.heappop(self.sleepers)
+      self.current = max(self.current, deadline)
+      if not fut.cancelled():
+        fut.set_result(None)
+      await settle()
+      if self.on_wake:
+        self.on_wake(self.current)
+    self.current = max(self.current, t)
+
+
+async def settle(rounds=20):
+  # Give every runnable task (in practice, run_game) a chance to react
+  # to whatever just happened before the next event is delivered.
+  for i in range(rounds):
+    await asyncio.sleep(0)
+
+
+class ReplayTeam:
+  def __init__(self, name, size, stats):
+    self.name = name
+    self.size = size
+    self.stats = stats
+
+  def __str__(self):
+    return self.name
+
+  async def send_messages(self, objs, sticky=None):
+    self.stats.broadcasts[self.name] += 1
+
+
+class ReplayStats:
+  def __init__(self):
+    self.broadcasts = collections.Counter()
+    self.events = collections.Counter()
+    # Real (wall) seconds spent delivering each event and letting the
+    # game react, charged to the phase of the event's team.  This
+    # includes any other team's run_game that happened to wake up
+    # during the same settle().
+    self.wall_by_phase = collections.Counter()
+    self.game_by_phase = collections.Counter()  # virtual seconds spent
+    self.phase_since = {}                       # team: (phase, start)
+
+  def note_phases(self, now):
+    for team, gs in GameState.BY_TEAM.items():
+      old = self.phase_since.get(team)
+      if old is None or old[0] != gs.phase:
+        if old is not None:
+          self.game_by_phase[old[0]] += now - old[1]
+        self.phase_since[team] = (gs.phase, now)
+
+  def finish(self, now):
+    for phase, start in self.phase_since.values():
+      self.game_by_phase[phase] += now - start
+    self.phase_since = {}
+
+  def report(self):
+    print(f"events:     {sum(self.events.values())}")
+    for method, count in sorted(self.events.items()):
+      print(f"  {method:12s} {count}")
+    print(f"broadcasts: {sum(self.broadcasts.values())}")
+    for team, count in sorted(self.broadcasts.items()):
+      print(f"  {team:20s} {count}")
+    print("phase        wall ms   game sec")
+    for phase in sorted(set(self.wall_by_phase) | set(self.game_by_phase)):
+      print(f"  {phase:10s} {self.wall_by_phase[phase]*1000:8.1f}"
+            f" {self.game_by_phase[phase]:10.1f}")
+
+
+async def deliver(ev, teams, stats):
+  name = ev["team"]
+  team = teams.get(name)
+  if team is None:
+    team = teams[name] = ReplayTeam(name, ev["size"], stats)
+  gs = GameState.get_for_team(team)
+
+  method = ev["method"]
+  stats.events[method] += 1
+  if method == "on_wait":
+    # Mirrors HatVennDorApp.on_wait.
+    if not gs.running:
+      gs.running = True
+      asyncio.get_event_loop().create_task(gs.run_game())
+    await gs.on_wait(ev["session"], ev["wid"])
+  elif method == "place_chunk":
+    await gs.place_chunk(ev["session"], ev["wid"], ev["chunk"], ev["target"])
+  elif method == "try_answer":
+    await gs.try_answer(ev["answer"])
+  elif method == "set_name":
+    await gs.set_name(ev["session"], ev["name"])
+  elif method == "send_chat":
+    await gs.send_chat(ev["text"])
+  else:
+    raise ValueError(f"unknown method {method!r}")
+
+
+async def replay(events, options):
+  stats = ReplayStats()
+  teams = {}
+
+  # Phases also change when a sleeping run_game wakes (eg, clue -> venn
+  # after the pause showing the last answer), not only on events.
+  clock = VirtualClock(events[0]["time"] if events else 0.0,
+                       on_wake=stats.note_phases)
+  GameState.now = staticmethod(clock.now)
+  GameState.sleep = staticmethod(clock.sleep)
+
+  hat_venn_dor.make_app(options)
+
+  for ev in events:
+    await clock.advance_to(ev["time"])
+    stats.note_phases(clock.now())
+
+    # Attribute real time to the phase of the team the event is for.
+    gs = GameState.BY_TEAM.get(teams.get(ev["team"]))
+    phase = gs.phase if gs else "waiting"
+    start = time.perf_counter()
+    await deliver(ev, teams, stats)
+    await settle()
+    stats.wall_by_phase[phase] += time.perf_counter() - start
+    stats.note_phases(clock.now())
+
+  # Let any trailing pauses (eg, the one after the last center answer)
+  # run out.
+  await clock.advance_to(clock.now() + options.drain)
+  stats.note_phases(clock.now())
+  stats.finish(clock.now())
+
+  for task in asyncio.all_tasks():
+    if task is not asyncio.current_task():
+      task.cancel()
+
+  return stats
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Replay recorded hat venn-dor traffic.")
+  parser.add_argument("log", help="File written by --record_file.")
+  parser.add_argument("--seed", type=int, default=None,
+                      help="Override the seed recorded in the log.")
+  parser.add_argument("--min_players", type=int, default=None,
+                      help="Override the --min_players recorded in the log.")
+  parser.add_argument("--drain", type=float, default=10.0,
+                      help="Virtual seconds to run past the last event.")
+  options = parser.parse_args()
+
+  options.debug = False
+  options.record_file = None
+  options.ops_key = None
+  options.assets = {"endcard.png": "endcard.png"}
+
+  with open(options.log) as f:
+    events = [json.loads(line) for line in f if line.strip()]
+  header = events.pop(0)
+  assert header["method"] == "header", "log has no header"
+  if options.seed is None:
+    options.seed = header["seed"]
+  if options.min_players is None:
+    options.min_players = header["min_players"]
+  events.sort(key=lambda ev: ev["time"])
+
+  stats = asyncio.run(replay(events, options))
+  stats.report()
+
+
+if __name__ == "__main__":
+  main()